@@ -1,35 +1,50 @@
 # app/api.py
 import json
+import math
 import os
 import time
 import base64
+import hmac
 import uuid
 # 顶部 import 区补一行
 from app.personas import get_persona, build_system_prompt  # 载入系统提示构建器
-from typing import Any, AsyncGenerator, Dict, List, Optional
+from typing import Any, AsyncGenerator, Dict, Iterator, List, Optional
 from pathlib import Path
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException, Query, Request
 from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
 
 from openai import AsyncOpenAI
 
-from app.db import append_message, get_recent_messages, get_session, create_session
+from app.db import append_message, get_session, create_session
+from app.db import list_messages, iter_export_messages, list_session_ids_by_persona
+from app.db import record_usage, get_usage_stats
 from app.personas import get_persona  # 仍然使用已有的 get_persona
-from app.personas import get_taxonomies
+from app.personas import get_taxonomies, PERSONAS
 from app.isi import create_isi_token, tts_stream_via_isi
+from app.prompt import assemble_messages
+from app.limits import SessionTurnLocks, RateLimiter, estimate_tokens
 
 DASH_BASE_URL = os.getenv("DASH_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
 API_KEY = os.getenv("DASHSCOPE_API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME", "qwen-plus")
 MAX_CONTEXT_MESSAGES = 30
+MAX_HISTORY_PAGE = 200
+EXPORT_BATCH_SIZE = 1000
+# 按 persona 批量导出会包含所有用户的会话，仅限运维调用；未配置时该接口一律 403
+EXPORT_ADMIN_TOKEN = os.getenv("EXPORT_ADMIN_TOKEN", "")
 
 if not API_KEY:
     raise RuntimeError("缺少 DASHSCOPE_API_KEY，请在 .env 或系统变量中设置。")
 
 client = AsyncOpenAI(api_key=API_KEY, base_url=DASH_BASE_URL)
 
+# 同一会话的轮次串行化 + 按 session/ip/persona 的令牌桶限流（进程内）
+session_turn_locks = SessionTurnLocks()
+rate_limiter = RateLimiter.from_env()
+
 router = APIRouter(prefix="/api", tags=["api"])
 print("[api loaded from]", __file__)
 
@@ -115,11 +130,83 @@ async def create_session_route(body: CreateSessionBody):
     return JSONResponse({"sessionId": sid})
 
 
+# ========================
+# 历史消息（keyset 分页）与导出（NDJSON 流式）
+# ========================
+@router.get("/session/{session_id}/messages")
+async def list_messages_route(
+    session_id: str,
+    limit: int = Query(default=50, ge=1, le=MAX_HISTORY_PAGE),
+    before: Optional[int] = Query(default=None, description="取 id 更小（更早）的消息"),
+    after: Optional[int] = Query(default=None, description="取 id 更大（更新）的消息"),
+):
+    """
+    分页读取会话历史，消息按 old->new 返回。
+    - 不带游标：最新 limit 条；before=<id>：继续向前翻；after=<id>：取之后的新消息。
+    - hasMore 表示当前翻页方向上是否还有数据；before/after 为本页首尾 id，可直接作为下一页游标。
+    """
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="before 与 after 不能同时指定")
+    if not get_session(session_id):
+        raise HTTPException(status_code=404, detail="会话不存在")
+    msgs, has_more = list_messages(session_id, limit, before_id=before, after_id=after)
+    return JSONResponse({
+        "messages": msgs,
+        "hasMore": has_more,
+        "before": msgs[0]["id"] if msgs else before,
+        "after": msgs[-1]["id"] if msgs else after,
+    })
+
+
+@router.get("/session/{session_id}/usage")
+async def session_usage_route(session_id: str):
+    """会话的 token 用量汇总（含上游前缀缓存命中比例与平均首字延迟）"""
+    if not get_session(session_id):
+        raise HTTPException(status_code=404, detail="会话不存在")
+    return JSONResponse(get_usage_stats(session_id))
+
+
+def _ndjson_stream(session_ids: List[str]) -> Iterator[bytes]:
+    """每批消息拼成一个 chunk 输出，避免逐行 yield 的开销；内存只与批大小有关。"""
+    for batch in iter_export_messages(session_ids, EXPORT_BATCH_SIZE):
+        yield "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in batch).encode("utf-8")
+
+
+_NDJSON_HEADERS = {
+    "Cache-Control": "no-cache, no-transform",
+    "X-Accel-Buffering": "no",
+}
+
+
+@router.get("/session/{session_id}/export")
+async def export_session_route(session_id: str):
+    """导出单个会话的全部消息（application/x-ndjson，一行一条）"""
+    if not get_session(session_id):
+        raise HTTPException(status_code=404, detail="会话不存在")
+    headers = {**_NDJSON_HEADERS, "Content-Disposition": f'attachment; filename="{session_id}.ndjson"'}
+    return StreamingResponse(_ndjson_stream([session_id]), media_type="application/x-ndjson", headers=headers)
+
+
+@router.get("/persona/{slug}/export")
+async def export_persona_route(slug: str, x_admin_token: Optional[str] = Header(default=None)):
+    """导出某个 persona 下所有会话的消息（按会话创建时间、消息 id 顺序）；需请求头 X-Admin-Token"""
+    if not EXPORT_ADMIN_TOKEN or not hmac.compare_digest(
+        (x_admin_token or "").encode("utf-8"), EXPORT_ADMIN_TOKEN.encode("utf-8")
+    ):
+        raise HTTPException(status_code=403, detail="无权导出")
+    if slug not in PERSONAS and slug not in load_custom_personas():
+        raise HTTPException(status_code=404, detail="persona 不存在")
+    # 未指定 persona 的会话在对话时回退为默认人设（见 get_persona），导出时也归入默认人设
+    session_ids = list_session_ids_by_persona(slug, include_unassigned=slug == get_persona(None)["slug"])
+    headers = {**_NDJSON_HEADERS, "Content-Disposition": f'attachment; filename="{slug}.ndjson"'}
+    return StreamingResponse(_ndjson_stream(session_ids), media_type="application/x-ndjson", headers=headers)
+
+
 # ========================
 # 文本聊天（SSE 流式）
 # ========================
 @router.post("/chat")
-async def chat_route(body: ChatBody):
+async def chat_route(body: ChatBody, request: Request):
     """向指定会话发送一条消息，流式返回大模型回复（会计费）"""
     session = get_session(body.sessionId)
     if not session:
@@ -129,37 +216,83 @@ async def chat_route(body: ChatBody):
     if not user_text:
         raise HTTPException(status_code=400, detail="userMessage 不能为空")
 
-    append_message(body.sessionId, "user", user_text)
+    # 同一会话同时只允许一个轮次：后到者按 CHAT_TURN_WAIT_SECONDS 排队，超时/不排队则 409
+    release_turn = await session_turn_locks.acquire(body.sessionId)
+    if release_turn is None:
+        raise HTTPException(status_code=409, detail="该会话上一轮回复尚未结束")
 
-    # 若 personaSlug 指定则以其为准，否则取 session 中的 persona_slug
-    persona = get_persona(body.personaSlug or session["persona_slug"])
-    recent = get_recent_messages(body.sessionId, MAX_CONTEXT_MESSAGES)
-
-    messages: List[Dict[str, str]] = [
-        {"role": "system", "content": persona.get("systemPrompt", f"你是{persona.get('name','助手')}。")},
-        *recent,
-        {"role": "user", "content": user_text},
-    ]
+    try:
+        # 若 personaSlug 指定则以其为准，否则取 session 中的 persona_slug
+        persona = get_persona(body.personaSlug or session["persona_slug"])
+        # 先组装（历史中尚不含本轮用户消息），再落库，避免本轮消息出现两次
+        messages = assemble_messages(
+            persona, body.sessionId, user_text, summary=session["summary"], max_messages=MAX_CONTEXT_MESSAGES
+        )
+
+        retry_after = rate_limiter.check(
+            {
+                "session": body.sessionId,
+                "ip": request.client.host if request.client else "unknown",
+                "persona": persona.get("slug") or "generic-guide",
+            },
+            estimate_tokens(messages),
+        )
+        if retry_after > 0:
+            raise HTTPException(
+                status_code=429,
+                detail="请求过于频繁，请稍后再试",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+        append_message(body.sessionId, "user", user_text)
+    except BaseException:
+        release_turn()
+        raise
 
     async def event_stream() -> AsyncGenerator[bytes, None]:
-        assistant_text = ""
         try:
-            stream = await client.chat.completions.create(
-                model=MODEL_NAME,
-                stream=True,
-                messages=messages,  # type: ignore
-            )
-            async for chunk in stream:
-                delta = chunk.choices[0].delta.content or ""
-                if delta:
-                    assistant_text += delta
-                    yield f"data: {json.dumps({'delta': delta})}\n\n".encode("utf-8")
-        except Exception as e:
-            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n".encode("utf-8")
-        finally:
+            assistant_text = ""
+            usage = None
+            started = time.perf_counter()
+            ttft_ms: Optional[int] = None
+            try:
+                stream = await client.chat.completions.create(
+                    model=MODEL_NAME,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    messages=messages,  # type: ignore
+                )
+                async for chunk in stream:
+                    # include_usage 时最后一个 chunk 只有 usage、choices 为空
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content or ""
+                    if delta:
+                        if ttft_ms is None:
+                            ttft_ms = int((time.perf_counter() - started) * 1000)
+                        assistant_text += delta
+                        yield f"data: {json.dumps({'delta': delta})}\n\n".encode("utf-8")
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n".encode("utf-8")
+            finally:
+                # 先落库再发 done：客户端若在某次 yield 处断开，生成器会在那里被关闭，
+                # 之后的语句不再执行；这里不含 yield，断开时也能保证回复与计费记录写入
+                if assistant_text.strip():
+                    append_message(body.sessionId, "assistant", assistant_text.strip())
+                if usage is not None:
+                    details = getattr(usage, "prompt_tokens_details", None)
+                    record_usage(
+                        body.sessionId,
+                        MODEL_NAME,
+                        usage.prompt_tokens or 0,
+                        getattr(details, "cached_tokens", None) or 0,
+                        usage.completion_tokens or 0,
+                        ttft_ms,
+                    )
             yield b"data: {\"done\": true}\n\n"
-            if assistant_text.strip():
-                append_message(body.sessionId, "assistant", assistant_text.strip())
+        finally:
+            release_turn()
 
     headers = {
         "Content-Type": "text/event-stream; charset=utf-8",
@@ -167,7 +300,8 @@ async def chat_route(body: ChatBody):
         "Connection": "keep-alive",
         "X-Accel-Buffering": "no",
     }
-    return StreamingResponse(event_stream(), headers=headers)
+    # 客户端在流开始前断开时生成器不会执行，由 background 兜底释放（release_turn 幂等）
+    return StreamingResponse(event_stream(), headers=headers, background=BackgroundTask(release_turn))
 
 
 # ========================
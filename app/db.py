@@ -1,7 +1,7 @@
 # app/db.py
 import os
 import sqlite3
-from typing import List, Literal, Optional, Tuple, TypedDict
+from typing import Iterator, List, Literal, Optional, Tuple, TypedDict
 
 DB_PATH = os.getenv("DB_PATH", "./var/data.db")
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
@@ -15,7 +15,8 @@ CREATE TABLE IF NOT EXISTS sessions (
   id TEXT PRIMARY KEY,
   persona_slug TEXT,
   summary TEXT,
-  created_at INTEGER
+  created_at INTEGER,
+  message_count INTEGER DEFAULT 0
 );
 CREATE TABLE IF NOT EXISTS messages (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -24,8 +25,29 @@ CREATE TABLE IF NOT EXISTS messages (
   content TEXT,
   created_at INTEGER
 );
+-- 按会话取历史/分页/导出都走 (session_id, id)，避免全表扫描
+CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages (session_id, id);
+CREATE INDEX IF NOT EXISTS idx_sessions_persona_slug ON sessions (persona_slug);
+-- 每次调用大模型的 usage（含上游前缀缓存命中的 token 数）与首字延迟
+CREATE TABLE IF NOT EXISTS usage_log (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  session_id TEXT,
+  model TEXT,
+  prompt_tokens INTEGER,
+  cached_tokens INTEGER,
+  completion_tokens INTEGER,
+  ttft_ms INTEGER,
+  created_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_usage_log_session_id ON usage_log (session_id);
 """
 )
+# 旧库迁移：补 sessions.message_count 列，并按现有消息回填一次
+if "message_count" not in {r["name"] for r in _conn.execute("PRAGMA table_info(sessions)")}:
+    _conn.execute("ALTER TABLE sessions ADD COLUMN message_count INTEGER DEFAULT 0")
+    _conn.execute(
+        "UPDATE sessions SET message_count=(SELECT COUNT(1) FROM messages WHERE messages.session_id=sessions.id)"
+    )
 _conn.commit()
 
 Role = Literal["system", "user", "assistant"]
@@ -34,6 +56,22 @@ class ChatMessage(TypedDict):
     role: Role
     content: str
 
+class StoredMessage(TypedDict):
+    id: int
+    sessionId: str
+    role: Role
+    content: str
+    createdAt: int
+
+def _to_stored(r: sqlite3.Row) -> StoredMessage:
+    return {
+        "id": r["id"],
+        "sessionId": r["session_id"],
+        "role": r["role"],
+        "content": r["content"],
+        "createdAt": r["created_at"],
+    }
+
 def create_session(persona_slug: Optional[str] = None) -> str:
     import uuid, time
     sid = str(uuid.uuid4())
@@ -54,6 +92,7 @@ def append_message(session_id: str, role: Role, content: str) -> None:
         "INSERT INTO messages (session_id, role, content, created_at) VALUES (?,?,?,?)",
         (session_id, role, content, int(time.time() * 1000)),
     )
+    _conn.execute("UPDATE sessions SET message_count=message_count+1 WHERE id=?", (session_id,))
     _conn.commit()
 
 def get_recent_messages(session_id: str, limit: int = 30) -> List[ChatMessage]:
@@ -70,6 +109,123 @@ def count_messages(session_id: str) -> int:
     row = cur.fetchone()
     return int(row["c"] if row and row["c"] is not None else 0)
 
+def get_message_count(session_id: str) -> int:
+    """会话消息数（读 sessions.message_count，O(1)；由 append_message 维护）"""
+    cur = _conn.execute("SELECT message_count FROM sessions WHERE id=?", (session_id,))
+    row = cur.fetchone()
+    return int(row["message_count"] if row and row["message_count"] is not None else 0)
+
 def set_summary(session_id: str, summary: str) -> None:
     _conn.execute("UPDATE sessions SET summary=? WHERE id=?", (summary, session_id))
     _conn.commit()
+
+def list_messages(
+    session_id: str,
+    limit: int = 50,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+) -> Tuple[List[StoredMessage], bool]:
+    """按 messages.id 做 keyset 分页，返回 (old->new 的消息, 该方向是否还有更多)。
+    - after_id 给定：取 id > after_id 的最早 limit 条（向新翻页）
+    - 否则：取 id < before_id（未给定则为最新）的最近 limit 条（向旧翻页）
+    """
+    if after_id is not None:
+        cur = _conn.execute(
+            "SELECT * FROM messages WHERE session_id=? AND id>? ORDER BY id ASC LIMIT ?",
+            (session_id, after_id, limit + 1),
+        )
+        rows = cur.fetchall()
+    else:
+        if before_id is not None:
+            cur = _conn.execute(
+                "SELECT * FROM messages WHERE session_id=? AND id<? ORDER BY id DESC LIMIT ?",
+                (session_id, before_id, limit + 1),
+            )
+        else:
+            cur = _conn.execute(
+                "SELECT * FROM messages WHERE session_id=? ORDER BY id DESC LIMIT ?",
+                (session_id, limit + 1),
+            )
+        rows = cur.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is None:
+        rows.reverse()
+    return [_to_stored(r) for r in rows], has_more
+
+def record_usage(
+    session_id: str,
+    model: str,
+    prompt_tokens: int,
+    cached_tokens: int,
+    completion_tokens: int,
+    ttft_ms: Optional[int] = None,
+) -> None:
+    import time
+    _conn.execute(
+        "INSERT INTO usage_log (session_id, model, prompt_tokens, cached_tokens, completion_tokens, ttft_ms, created_at)"
+        " VALUES (?,?,?,?,?,?,?)",
+        (session_id, model, prompt_tokens, cached_tokens, completion_tokens, ttft_ms, int(time.time() * 1000)),
+    )
+    _conn.commit()
+
+def get_usage_stats(session_id: str) -> dict:
+    """汇总会话的 token 用量；cachedRatio = 命中前缀缓存的 prompt token 占比"""
+    cur = _conn.execute(
+        "SELECT COUNT(1) AS n, SUM(prompt_tokens) AS p, SUM(cached_tokens) AS c,"
+        " SUM(completion_tokens) AS o, AVG(ttft_ms) AS t FROM usage_log WHERE session_id=?",
+        (session_id,),
+    )
+    row = cur.fetchone()
+    prompt = int(row["p"] or 0)
+    cached = int(row["c"] or 0)
+    return {
+        "requests": int(row["n"] or 0),
+        "promptTokens": prompt,
+        "cachedTokens": cached,
+        "completionTokens": int(row["o"] or 0),
+        "cachedRatio": (cached / prompt) if prompt else 0.0,
+        "avgTtftMs": row["t"],
+    }
+
+def _open_reader() -> sqlite3.Connection:
+    """导出专用的只读连接：WAL 下与写连接互不阻塞，且不与共享的 _conn 抢游标。"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only=ON;")
+    return conn
+
+def iter_export_messages(
+    session_ids: List[str], batch_size: int = 1000
+) -> Iterator[List[StoredMessage]]:
+    """按会话依次流式读出全部消息，每次产出一批（最多 batch_size 条）。
+    整个导出在同一读事务（快照）内完成，内存只与 batch_size 有关。"""
+    conn = _open_reader()
+    try:
+        conn.execute("BEGIN")
+        for sid in session_ids:
+            cur = conn.execute(
+                "SELECT * FROM messages WHERE session_id=? ORDER BY id ASC", (sid,)
+            )
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [_to_stored(r) for r in rows]
+    finally:
+        conn.close()
+
+def list_session_ids_by_persona(persona_slug: str, include_unassigned: bool = False) -> List[str]:
+    """按 persona 列出会话；include_unassigned 时一并包含未指定 persona（persona_slug 为空）的会话"""
+    if include_unassigned:
+        cur = _conn.execute(
+            "SELECT id FROM sessions WHERE persona_slug=? OR persona_slug IS NULL OR persona_slug=''"
+            " ORDER BY created_at, id",
+            (persona_slug,),
+        )
+    else:
+        cur = _conn.execute(
+            "SELECT id FROM sessions WHERE persona_slug=? ORDER BY created_at, id",
+            (persona_slug,),
+        )
+    return [r["id"] for r in cur.fetchall()]
@@ -0,0 +1,196 @@
+# app/limits.py
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# 同一会话的第二个并发轮次最多排队等待多少秒；0 表示直接拒绝
+CHAT_TURN_WAIT_SECONDS = float(os.getenv("CHAT_TURN_WAIT_SECONDS", "0"))
+# 估算 token 时为回复预留的额度
+ESTIMATED_COMPLETION_TOKENS = int(os.getenv("ESTIMATED_COMPLETION_TOKENS", "256"))
+LIMITS_MAX_ENTRIES = int(os.getenv("LIMITS_MAX_ENTRIES", "100000"))
+SESSION_LOCK_IDLE_SECONDS = float(os.getenv("SESSION_LOCK_IDLE_SECONDS", "600"))
+
+
+class _LockEntry:
+    __slots__ = ("lock", "refs", "last_used")
+
+    def __init__(self, now: float):
+        self.lock = asyncio.Lock()
+        self.refs = 0          # 持有者 + 等待者；>0 时不可淘汰
+        self.last_used = now
+
+
+class SessionTurnLocks:
+    """
+    按 sessionId 串行化聊天轮次（进程内、仅在事件循环线程使用）。
+    条目按 LRU 排列：空闲超过 idle_seconds 或总数超过 max_entries 时淘汰未被占用的条目。
+    """
+
+    def __init__(self, max_entries: int = LIMITS_MAX_ENTRIES, idle_seconds: float = SESSION_LOCK_IDLE_SECONDS):
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self._entries: "OrderedDict[str, _LockEntry]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict(self, now: float) -> None:
+        # 只看 LRU 一端，摊还 O(1)；正在使用的条目跳过（移到尾部）
+        for _ in range(len(self._entries)):
+            key, entry = next(iter(self._entries.items()))
+            idle = now - entry.last_used >= self.idle_seconds
+            if not idle and len(self._entries) <= self.max_entries:
+                break
+            if entry.refs:
+                self._entries.move_to_end(key)
+                continue
+            del self._entries[key]
+
+    async def acquire(self, key: str, timeout: float = CHAT_TURN_WAIT_SECONDS) -> Optional[Callable[[], None]]:
+        """获取会话锁；成功返回幂等的 release 函数，超时/忙返回 None。"""
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = _LockEntry(now)
+            self._entries[key] = entry
+        else:
+            self._entries.move_to_end(key)
+        entry.last_used = now
+        entry.refs += 1  # 先占用，防止被下面的淘汰清掉
+        self._evict(now)
+
+        if entry.lock.locked() and timeout <= 0:
+            entry.refs -= 1
+            return None
+        try:
+            await asyncio.wait_for(entry.lock.acquire(), timeout=timeout if timeout > 0 else None)
+        except asyncio.TimeoutError:
+            entry.refs -= 1
+            return None
+        except BaseException:
+            entry.refs -= 1
+            raise
+
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if released:
+                return
+            released = True
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+            entry.lock.release()
+
+        return release
+
+
+class TokenBuckets:
+    """
+    一组令牌桶：每个 key 容量为 capacity，每秒补充 rate。
+    已回满的桶与新建的桶等价，丢弃它不影响限流结果，因此按此做无损过期；
+    另以 max_entries 限制总数。
+    """
+
+    def __init__(self, capacity: float, rate: float, max_entries: int = LIMITS_MAX_ENTRIES):
+        self.capacity = capacity
+        self.rate = rate
+        self.max_entries = max_entries
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()  # key -> [tokens, updated_at]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _evict(self, now: float) -> None:
+        # 按最后更新时间排列，只看最旧一端，摊还 O(1)
+        b = self._buckets
+        while b:
+            key = next(iter(b))
+            if self.peek(key, now) < self.capacity and len(b) <= self.max_entries:
+                break
+            del b[key]
+
+    def peek(self, key: str, now: float) -> float:
+        """当前可用令牌数（不修改状态）"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        tokens, updated = bucket
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def take(self, key: str, amount: float, now: float) -> None:
+        tokens = self.peek(key, now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._buckets[key] = [tokens - amount, now]
+        else:
+            bucket[0] = tokens - amount
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        self._evict(now)
+
+    def retry_after(self, key: str, amount: float, now: float) -> float:
+        """还需等待多少秒才能取出 amount；0 表示现在即可"""
+        missing = min(amount, self.capacity) - self.peek(key, now)
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else math.inf
+
+
+def _per_minute_bucket(env: str) -> Optional[TokenBuckets]:
+    """读取每分钟额度（如 RATE_LIMIT_IP_RPM=60）；未设置或为 0 表示不限"""
+    per_minute = float(os.getenv(env, "0") or 0)
+    if per_minute <= 0:
+        return None
+    return TokenBuckets(capacity=per_minute, rate=per_minute / 60.0)
+
+
+class RateLimiter:
+    """按 session / ip / persona 三个维度，分别以请求数与估算 token 数限流。"""
+
+    SCOPES = ("session", "ip", "persona")
+
+    def __init__(self, buckets: Dict[Tuple[str, str], TokenBuckets]):
+        # (scope, unit) -> TokenBuckets；unit 为 "requests" 或 "tokens"
+        self.buckets = buckets
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        buckets: Dict[Tuple[str, str], TokenBuckets] = {}
+        for scope in cls.SCOPES:
+            for unit, suffix in (("requests", "RPM"), ("tokens", "TPM")):
+                b = _per_minute_bucket(f"RATE_LIMIT_{scope.upper()}_{suffix}")
+                if b is not None:
+                    buckets[(scope, unit)] = b
+        return cls(buckets)
+
+    def check(self, keys: Dict[str, str], tokens: int, now: Optional[float] = None) -> float:
+        """
+        keys: {"session": ..., "ip": ..., "persona": ...}
+        全部桶都够时才一起扣减并返回 0；否则不扣减，返回需要等待的秒数。
+        """
+        if not self.buckets:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        wanted: List[Tuple[TokenBuckets, str, float]] = []
+        wait = 0.0
+        for (scope, unit), b in self.buckets.items():
+            key = keys.get(scope)
+            if key is None:
+                continue
+            amount = 1.0 if unit == "requests" else float(tokens)
+            wait = max(wait, b.retry_after(key, amount, now))
+            wanted.append((b, key, amount))
+        if wait > 0:
+            return wait
+        for b, key, amount in wanted:
+            b.take(key, amount, now)
+        return 0.0
+
+
+def estimate_tokens(messages: Sequence[Dict[str, str]]) -> int:
+    """粗略估算本次调用的 token：中文约 1 字 1 token，按字符数计（偏保守），再加回复预留"""
+    return sum(len(m.get("content") or "") for m in messages) + ESTIMATED_COMPLETION_TOKENS
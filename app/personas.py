@@ -29,6 +29,9 @@ class Persona(TypedDict, total=False):
     # 示例学习（可选）
     fewshot: List[Dict[str, str]]  # 例：[{role:"user",content:"..."}, {role:"assistant",content:"..."}]
 
+    # 预编译结果（由 build_system_prompt 生成）
+    systemPrompt: str
+
 def _as_bullets(v: Union[str, List[str], None]) -> str:
     """把字符串或字符串列表转成条目文本；为空返回空串。"""
     if not v:
@@ -130,6 +133,10 @@ PERSONAS: Dict[str, Persona] = {
     },
 }
 
+# 内置人设启动时预编译 systemPrompt，保证每次请求的 system 前缀逐字节一致
+for _p in PERSONAS.values():
+    _p.setdefault("systemPrompt", build_system_prompt(_p))
+
 # app/personas.py 追加在文件靠后处（或任意位置，但要在最末行之前）
 
 # 默认分类（可按需扩充）
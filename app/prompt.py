@@ -0,0 +1,69 @@
+# app/prompt.py
+import json
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from app.db import ChatMessage, get_message_count, get_recent_messages
+from app.personas import Persona, build_system_prompt
+
+# 历史窗口的起点按该步长对齐：起点每 STEP 条消息才移动一次，
+# 期间每轮请求都是上一轮的前缀 + 追加，便于命中上游的前缀缓存
+HISTORY_WINDOW_STEP = 10
+
+# 只有这些字段会影响提示词（排除 file 等可能很大的展示字段）
+_PROMPT_FIELDS = tuple(Persona.__annotations__)
+
+
+@lru_cache(maxsize=256)
+def _compile_prefix(persona_key: str) -> Tuple[Tuple[str, str], ...]:
+    """把人设编译成固定的前缀：system 提示 + few-shot 示例。按内容缓存，每个人设只编译一次。"""
+    p = json.loads(persona_key)
+    system = p.get("systemPrompt") or build_system_prompt(p)
+    prefix = [("system", system)]
+    for ex in p.get("fewshot") or []:
+        if not isinstance(ex, dict):
+            continue
+        role, content = ex.get("role"), ex.get("content")
+        if role in ("user", "assistant") and content:
+            prefix.append((role, content))
+    return tuple(prefix)
+
+
+def persona_prefix(persona: Persona) -> List[ChatMessage]:
+    """返回人设的固定前缀消息（每次调用都是新 list，可安全修改）"""
+    key = json.dumps(
+        {k: persona.get(k) for k in _PROMPT_FIELDS if persona.get(k) is not None},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return [{"role": role, "content": content} for role, content in _compile_prefix(key)]  # type: ignore
+
+
+def stable_history(session_id: str, max_messages: int) -> List[ChatMessage]:
+    """取最近不超过 max_messages 条历史，但窗口起点对齐到 HISTORY_WINDOW_STEP 的整数倍。"""
+    total = get_message_count(session_id)
+    rows = get_recent_messages(session_id, max_messages)
+    overflow = max(0, total - max_messages)
+    start = -(-overflow // HISTORY_WINDOW_STEP) * HISTORY_WINDOW_STEP
+    skip = start - (total - len(rows))
+    return rows[max(0, skip):]
+
+
+def assemble_messages(
+    persona: Persona,
+    session_id: str,
+    user_text: str,
+    summary: Optional[str] = None,
+    max_messages: int = 30,
+) -> List[ChatMessage]:
+    """
+    组装发送给大模型的 messages，布局为：
+      [system 提示, few-shot 示例..., <memory> 摘要] + 历史（只追加） + 本轮用户消息
+    前三段对同一人设/会话逐字节不变；需在写入本轮用户消息之前调用，避免其在历史中重复出现。
+    """
+    messages = persona_prefix(persona)
+    if summary:
+        messages.append({"role": "system", "content": f"<memory>\n{summary}\n</memory>"})
+    messages.extend(stable_history(session_id, max_messages))
+    messages.append({"role": "user", "content": user_text})
+    return messages
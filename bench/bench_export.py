@@ -0,0 +1,87 @@
+# bench/bench_export.py
+"""
+导出与分页基准：在临时库中造一个超长会话，测量
+  1) NDJSON 导出的吞吐与进程峰值内存（RSS）
+  2) keyset 分页与 OFFSET 分页的耗时对比
+用法：python bench/bench_export.py [--rows 1000000] [--batch 1000] [--pages 1000]
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _rss_mb() -> float:
+    # Linux 上 ru_maxrss 单位为 KB（macOS 为字节）
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=1_000_000)
+    ap.add_argument("--batch", type=int, default=1000)
+    ap.add_argument("--pages", type=int, default=1000)
+    ap.add_argument("--page-size", type=int, default=200)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="aichat-bench-")
+    os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")  # 必须在导入 app.db 之前设置
+    sys.path.insert(0, ROOT)
+    from app import db
+
+    try:
+        sid = db.create_session("socrates")
+        t = time.perf_counter()
+        db._conn.executemany(
+            "INSERT INTO messages (session_id, role, content, created_at) VALUES (?,?,?,?)",
+            (
+                (sid, "user" if i % 2 == 0 else "assistant", f"消息内容 {i} " + "x" * 80, i)
+                for i in range(args.rows)
+            ),
+        )
+        db._conn.commit()
+        print(f"seed: {args.rows} rows in {time.perf_counter() - t:.2f}s")
+
+        # 与 app/api.py:_ndjson_stream 相同的编码方式
+        rss_before = _rss_mb()
+        t = time.perf_counter()
+        n = nbytes = 0
+        for batch in db.iter_export_messages([sid], args.batch):
+            chunk = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in batch).encode("utf-8")
+            n += len(batch)
+            nbytes += len(chunk)
+        dt = time.perf_counter() - t
+        print(
+            f"export: {n} rows / {nbytes / 1e6:.0f}MB in {dt:.2f}s ({n / dt:,.0f} rows/s); "
+            f"max RSS {rss_before:.0f}MB -> {_rss_mb():.0f}MB"
+        )
+
+        pages = min(args.pages, args.rows // args.page_size)
+        t = time.perf_counter()
+        before = None
+        for _ in range(pages):
+            msgs, _more = db.list_messages(sid, args.page_size, before_id=before)
+            before = msgs[0]["id"]
+        print(f"keyset: {pages} pages of {args.page_size} in {time.perf_counter() - t:.3f}s")
+
+        t = time.perf_counter()
+        for i in range(pages):
+            db._conn.execute(
+                "SELECT * FROM messages WHERE session_id=? ORDER BY id DESC LIMIT ? OFFSET ?",
+                (sid, args.page_size, i * args.page_size),
+            ).fetchall()
+        print(f"offset: {pages} pages of {args.page_size} in {time.perf_counter() - t:.3f}s")
+    finally:
+        db._conn.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
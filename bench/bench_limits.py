@@ -0,0 +1,122 @@
+# bench/bench_limits.py
+"""
+会话锁与令牌桶：先做行为自检（失败即 AssertionError 退出），再测热路径开销与内存上界。
+用法：python bench/bench_limits.py [--ops 200000] [--sessions 300000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.limits import RateLimiter, SessionTurnLocks, TokenBuckets  # noqa: E402
+
+
+async def check_session_locks() -> None:
+    locks = SessionTurnLocks(max_entries=2, idle_seconds=60)
+
+    # 第二个并发轮次：不排队时直接拒绝；排队时等到前一轮释放
+    release = await locks.acquire("a", timeout=0)
+    assert release is not None
+    assert await locks.acquire("a", timeout=0) is None
+    assert await locks.acquire("a", timeout=0.01) is None  # 排队超时
+    waiter = asyncio.create_task(locks.acquire("a", timeout=1))
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+    release()
+    release()  # 幂等：重复释放不报错、不影响下一位持有者
+    release_b = await waiter
+    assert release_b is not None
+    assert await locks.acquire("a", timeout=0) is None
+
+    # 超出 max_entries / 空闲过期时都不淘汰被持有的条目
+    for key in ("b", "c", "d"):
+        r = await locks.acquire(key, timeout=0)
+        assert r is not None
+        r()
+    assert "a" in locks._entries and len(locks) <= 3
+    locks._evict(time.monotonic() + 3600)
+    assert list(locks._entries) == ["a"]
+    assert await locks.acquire("a", timeout=0) is None
+    release_b()
+    locks._evict(time.monotonic() + 3600)
+    assert len(locks) == 0
+
+
+def check_rate_limiter() -> None:
+    # 60 次/分钟：突发 60 次后拒绝，1 秒后补 1 次
+    rl = RateLimiter({("ip", "requests"): TokenBuckets(60, 1.0)})
+    allowed = sum(rl.check({"ip": "1.1.1.1"}, 0, now=100.0) == 0 for _ in range(100))
+    assert allowed == 60, allowed
+    assert abs(rl.check({"ip": "1.1.1.1"}, 0, now=100.0) - 1.0) < 1e-9
+    assert sum(rl.check({"ip": "1.1.1.1"}, 0, now=105.0) == 0 for _ in range(10)) == 5
+
+    # 全部扣减或全部不扣：token 桶不够时，请求数桶也不扣
+    reqs, toks = TokenBuckets(10, 1.0), TokenBuckets(100, 1.0)
+    rl = RateLimiter({("session", "requests"): reqs, ("session", "tokens"): toks})
+    assert rl.check({"session": "s"}, 80, now=0.0) == 0
+    assert reqs.peek("s", 0.0) == 9 and toks.peek("s", 0.0) == 20
+    assert rl.check({"session": "s"}, 50, now=0.0) > 0
+    assert reqs.peek("s", 0.0) == 9 and toks.peek("s", 0.0) == 20
+    # 未提供的维度不参与
+    assert rl.check({"ip": "x"}, 10_000, now=0.0) == 0
+
+    # 回满的桶被无损丢弃；总数受 max_entries 限制
+    b = TokenBuckets(10, 1.0, max_entries=3)
+    b.take("a", 5, 0.0)
+    b.take("b", 1, 20.0)
+    assert list(b._buckets) == ["b"]
+    for i in range(10):
+        b.take(f"k{i}", 1, 20.0)
+    assert len(b) == 3
+
+
+async def bench(ops: int, sessions: int) -> None:
+    locks = SessionTurnLocks(max_entries=100_000, idle_seconds=600)
+    tracemalloc.start()
+    for i in range(sessions):
+        r = await locks.acquire(f"sess-{i}", timeout=0)
+        r()
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"locks: {sessions} sessions -> {len(locks)} entries ({traced / 1e6:.1f}MB traced)")
+
+    t = time.perf_counter()
+    for i in range(ops):
+        r = await locks.acquire(f"sess-{i % 50_000}", timeout=0)
+        r()
+    print(f"locks: acquire+release {(time.perf_counter() - t) / ops * 1e6:.2f}us/op")
+
+    # 贴近实际的额度：每会话 20 次/6 万 token，每 IP 60 次/20 万 token，每 persona 基本不限
+    per_minute = {
+        ("session", "requests"): 20, ("session", "tokens"): 60_000,
+        ("ip", "requests"): 60, ("ip", "tokens"): 200_000,
+        ("persona", "requests"): 1e6, ("persona", "tokens"): 1e9,
+    }
+    rl = RateLimiter({k: TokenBuckets(v, v / 60.0) for k, v in per_minute.items()})
+    t = time.perf_counter()
+    for i in range(ops):
+        keys = {"session": f"s{i}", "ip": f"10.{i % 200}.{i // 200 % 200}.1", "persona": "socrates"}
+        rl.check(keys, 1500, now=i * 1e-4)
+    print(f"limiter: check over 6 buckets {(time.perf_counter() - t) / ops * 1e6:.2f}us/op")
+    print("limiter: entries", {f"{s}/{u}": len(b) for (s, u), b in rl.buckets.items()})
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--ops", type=int, default=200_000)
+    ap.add_argument("--sessions", type=int, default=300_000)
+    args = ap.parse_args()
+
+    asyncio.run(check_session_locks())
+    check_rate_limiter()
+    print("checks: ok")
+    asyncio.run(bench(args.ops, args.sessions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# bench/bench_prefix.py
+"""
+提示词前缀缓存基准：用模拟的大模型服务（带前缀缓存）逐轮驱动多个会话，对比
+  old：旧版 chat_route 的组装方式（先写入用户消息再取最近 N 条，本轮消息重复、窗口逐条滑动）
+  new：app.prompt.assemble_messages
+先对 assemble_messages 做行为自检（失败即 AssertionError 退出），
+再输出前缀缓存命中比例（cached/prompt tokens）与模拟的首字延迟（TTFT）。
+用法：python bench/bench_prefix.py [--sessions 5] [--turns 40] [--step 10]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class MockProvider:
+    """
+    模拟上游的前缀缓存：请求按字符近似 token，与此前任一请求取最长公共前缀，
+    命中长度向下对齐到 block，且不足 min_cached 不计；
+    TTFT = base_ms + 未命中 token 数 × prefill_ms_per_token。
+    """
+
+    def __init__(self, block: int = 64, min_cached: int = 256, base_ms: float = 120.0, prefill_ms_per_token: float = 0.08):
+        self.block = block
+        self.min_cached = min_cached
+        self.base_ms = base_ms
+        self.prefill_ms_per_token = prefill_ms_per_token
+        self._seen: List[str] = []
+
+    @staticmethod
+    def _common_prefix(a: str, b: str) -> int:
+        lo, hi = 0, min(len(a), len(b))
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if a[:mid] == b[:mid]:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def call(self, messages: List[Dict[str, str]]) -> Tuple[int, int, float]:
+        """返回 (prompt_tokens, cached_tokens, ttft_ms)"""
+        text = "".join(f"<|{m['role']}|>{m['content']}" for m in messages)
+        best = max((self._common_prefix(prev, text) for prev in self._seen), default=0)
+        cached = (best // self.block) * self.block if best >= self.min_cached else 0
+        self._seen.append(text)
+        return len(text), cached, self.base_ms + self.prefill_ms_per_token * (len(text) - cached)
+
+
+def _serialize(messages: List[Dict[str, str]]) -> str:
+    return "".join(f"<|{m['role']}|>{m['content']}" for m in messages)
+
+
+def check_assembly(db, prompt, persona, max_messages: int) -> None:
+    """逐轮检查 assemble_messages 的输出布局"""
+    step = prompt.HISTORY_WINDOW_STEP
+    assert 0 < step <= max_messages, (step, max_messages)
+    prefix = prompt.persona_prefix(persona)
+    fewshot = [m for m in persona.get("fewshot") or [] if m.get("role") in ("user", "assistant") and m.get("content")]
+    assert prefix[0]["role"] == "system" and prefix[1:] == fewshot
+
+    sid = db.create_session(persona.get("slug"))
+    prev_start, prev_text = None, None
+    for turn in range(3 * max_messages):
+        text = f"检查第{turn}轮"
+        stored = db.get_message_count(sid)
+        messages = prompt.assemble_messages(persona, sid, text, max_messages=max_messages)
+
+        # 固定前缀在最前，本轮用户消息只在末尾出现一次
+        assert messages[:len(prefix)] == prefix
+        assert messages[-1] == {"role": "user", "content": text}
+        assert sum(m["content"] == text for m in messages) == 1
+
+        # 历史窗口：起点按 STEP 对齐；存量超过上限时条数在 [max - STEP + 1, max]
+        history = messages[len(prefix):-1]
+        start = stored - len(history)
+        assert start % step == 0, (start, step)
+        if stored > max_messages:
+            assert max_messages - step + 1 <= len(history) <= max_messages, len(history)
+        else:
+            assert len(history) == stored
+
+        # 起点未移动的相邻两轮：上一轮的完整请求逐字节是这一轮的前缀
+        serialized = _serialize(messages)  # type: ignore
+        if start == prev_start:
+            assert serialized.startswith(prev_text)
+        prev_start, prev_text = start, serialized
+
+        db.append_message(sid, "user", text)
+        db.append_message(sid, "assistant", f"回答第{turn}轮")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sessions", type=int, default=5)
+    ap.add_argument("--turns", type=int, default=40)
+    ap.add_argument("--step", type=int, default=None, help="覆盖 app.prompt.HISTORY_WINDOW_STEP")
+    ap.add_argument("--persona", default="socrates")
+    ap.add_argument("--max-messages", type=int, default=30)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="aichat-bench-")
+    os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")  # 必须在导入 app.db 之前设置
+    sys.path.insert(0, ROOT)
+    from app import db, prompt
+    from app.personas import get_persona
+
+    if args.step is not None:
+        prompt.HISTORY_WINDOW_STEP = args.step
+    persona = get_persona(args.persona)
+
+    def old_layout(sid: str, text: str) -> List[Dict[str, str]]:
+        db.append_message(sid, "user", text)
+        recent = db.get_recent_messages(sid, args.max_messages)
+        return [
+            {"role": "system", "content": persona.get("systemPrompt", f"你是{persona.get('name','助手')}。")},
+            *recent,
+            {"role": "user", "content": text},
+        ]
+
+    def new_layout(sid: str, text: str) -> List[Dict[str, str]]:
+        messages = prompt.assemble_messages(persona, sid, text, max_messages=args.max_messages)
+        db.append_message(sid, "user", text)
+        return messages  # type: ignore
+
+    try:
+        check_assembly(db, prompt, persona, args.max_messages)
+        print("checks: ok")
+
+        for name, layout in (("old", old_layout), ("new", new_layout)):
+            rnd = random.Random(args.seed)  # 两种布局使用相同的对话内容
+            provider = MockProvider()
+            prompt_tokens = cached_tokens = 0
+            ttfts: List[float] = []
+            for _ in range(args.sessions):
+                sid = db.create_session(args.persona)
+                for turn in range(args.turns):
+                    p, c, t = provider.call(layout(sid, f"第{turn}个问题：" + "问" * rnd.randint(20, 60)))
+                    prompt_tokens += p
+                    cached_tokens += c
+                    ttfts.append(t)
+                    db.append_message(sid, "assistant", "答" * rnd.randint(60, 200))
+            print(
+                f"{name}: requests={len(ttfts)} prompt_tokens={prompt_tokens} cached_tokens={cached_tokens} "
+                f"cached_ratio={cached_tokens / prompt_tokens:.1%} avg_ttft={sum(ttfts) / len(ttfts):.0f}ms"
+            )
+    finally:
+        db._conn.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()